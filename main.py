@@ -2,8 +2,15 @@
 
 import logging
 import os
+import sys
+import threading
+import time
+
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.observers import Observer
 
 from src.encoder import process_all_videos
+from src.helper.constants import INPUT_FOLDER, STABLE_FILE_SECONDS
 
 LOG_FOLDER = "temp/logs"
 LOG_FILE = os.path.join(LOG_FOLDER, "encoder.log")
@@ -15,28 +22,107 @@ def init_logger() -> None:
     """
     os.makedirs(LOG_FOLDER, exist_ok=True)
 
+    handlers = [logging.FileHandler(LOG_FILE)]
+    # Only echo to the console for interactive runs, a background service just writes the file
+    if sys.stderr is not None and sys.stderr.isatty():
+        handlers.append(logging.StreamHandler())
+
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(LOG_FILE),
-            logging.StreamHandler()
-        ]
+        handlers=handlers
     )
 
 
 init_logger()
 logger = logging.getLogger(__name__)
 MONITORING = False
+# Serializes sweeps, so the startup sweep and watchdog events never encode the same file twice
+_sweep_lock = threading.Lock()
+
+
+def process_input_folder() -> None:
+    """
+    Processes the input folder, waiting for any sweep that is already running to finish first.
+    """
+    with _sweep_lock:
+        process_all_videos()
+
+
+def wait_for_complete_file(file_path: str) -> bool:
+    """
+    Waits until a file has stopped growing, as copiers write new files incrementally.
+
+    Also waits until the file was last modified at least STABLE_FILE_SECONDS ago,
+    as process_all_videos skips files that changed more recently.
+
+    Args:
+        file_path (str): Path to the file to watch.
+
+    Returns:
+        bool: True once the file size is stable, False if the file disappeared.
+    """
+    try:
+        size = os.path.getsize(file_path)
+        while True:
+            time.sleep(STABLE_FILE_SECONDS)
+            new_size = os.path.getsize(file_path)
+            if new_size == size:
+                break
+            size = new_size
+
+        while (remaining := os.path.getmtime(file_path) + STABLE_FILE_SECONDS - time.time()) > 0:
+            time.sleep(remaining)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class NewVideoHandler(FileSystemEventHandler):
+    """
+    Processes the input folder whenever a new file has completely arrived in it.
+    """
+
+    def on_created(self, event: FileSystemEvent) -> None:
+        if not event.is_directory:
+            self.process_new_file(event.src_path)
+
+    def on_moved(self, event: FileSystemEvent) -> None:
+        if not event.is_directory:
+            self.process_new_file(event.dest_path)
+
+    @staticmethod
+    def process_new_file(file_path: str) -> None:
+        """
+        Starts processing of the input folder once the new file is complete.
+        """
+        logger.info("Detected new file %s.", file_path)
+        # An exception escaping here would stop the observer thread and with it the service
+        try:
+            if wait_for_complete_file(file_path):
+                process_input_folder()
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Processing the input folder failed after %s arrived.", file_path)
 
 
 def monitor_folder():
     """
     Function to start watching a given folder.
     """
+    observer = Observer()
+    observer.schedule(NewVideoHandler(), INPUT_FOLDER)
+    observer.start()
     logger.info("Started monitoring folder...")
-    while True:
-        process_all_videos()
+    try:
+        # Pick up everything that arrived while the service was not running. The observer is
+        # already running, so files arriving or skipped as incomplete during this sweep still
+        # get an event.
+        process_input_folder()
+        while observer.is_alive():
+            observer.join(1)
+    finally:
+        observer.stop()
+        observer.join()
 
 
 if __name__ == '__main__':
@@ -1,150 +1,310 @@
 """Module providing the logic for handling the encoding of videos."""
 
+import atexit
+import contextlib
+import json
 import logging
 import os
 import shutil
 import subprocess
-from typing import List, Set
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Set, TextIO, Tuple
 
-import pymediainfo
+import psutil
 from smb.SMBConnection import SMBConnection
 
-from src.helper.constants import (INPUT_FOLDER, OUTPUT_FOLDER,
-                                  HANDBRAKE_CLI_PATH, PROCESSED_FILES_PATH, SUBTITLE_CRITERIA, NETWORK_FOLDER_PATH)
+from src.helper.constants import (INPUT_FOLDER, OUTPUT_FOLDER, HANDBRAKE_CLI_PATH,
+                                  PROCESSED_FILES_PATH, SUBTITLE_CRITERIA, NETWORK_FOLDER_PATH,
+                                  STABLE_FILE_SECONDS, THREADS_PER_ENCODE)
+from src.helper.mediainfo_cache import get_tracks
 
 logger = logging.getLogger(__name__)
 
+# Resolve HandBrakeCLI once and refuse to start without it, instead of failing every encode
+HANDBRAKE_CLI = shutil.which(HANDBRAKE_CLI_PATH) or HANDBRAKE_CLI_PATH
+if not os.path.isfile(HANDBRAKE_CLI):
+    raise RuntimeError(f"HandBrakeCLI not found at {HANDBRAKE_CLI_PATH}")
+
+# Run as many HandBrakeCLI instances as there are cores for their capped thread pools
+PARALLEL_ENCODES = max(1, (os.cpu_count() or 1) // THREADS_PER_ENCODE)
+# Hand out the remaining cores to the instances, so all of them together fill the machine
+ENCODER_THREADS = max(1, (os.cpu_count() or 1) // PARALLEL_ENCODES)
+# Only start another encode while at least half of one encoder's share of the CPU is idle
+MAX_START_CPU_LOAD = 100 - 50 / PARALLEL_ENCODES
+CPU_LOAD_SAMPLE_SECONDS = 5
+
+# Run the encoder with lowered CPU and IO priority so it doesn't starve foreground processes
+LOW_PRIORITY_COMMAND = ((('nice', '-n', '10') if shutil.which('nice') else ())
+                        + (('ionice', '-c', '3') if shutil.which('ionice') else ()))
+LOW_PRIORITY_CREATIONFLAGS = getattr(subprocess, 'BELOW_NORMAL_PRIORITY_CLASS', 0)
+
+# Program part of the command, resolved once for every encode
+HANDBRAKE_COMMAND = (*LOW_PRIORITY_COMMAND, HANDBRAKE_CLI)
+
+# Encoding options that are the same for every video
+HANDBRAKE_OPTIONS = (
+    '--encoder', 'x265_10bit',
+    '--encoder-preset', 'slow',
+    '--encoder-profile', 'main10',
+    '--encopts', f'pools={ENCODER_THREADS}',
+    '--quality', '19',
+    '--vfr',
+    '--crop-mode', 'auto',
+    '--auto-anamorphic',
+    '--lapsharp=light',
+    '--hqdn3d=light',
+    '--aencoder', 'copy',
+    '--audio-copy-mask', 'ac3,aac,eac3,dts',
+    '--audio-fallback', 'flac16',
+    '--aname', 'Deutsch,English',
+    '--native-language', 'deu',
+    '--markers',
+    '--turbo',
+    '--format', 'av_mkv',
+)
+
+# Number of trailing HandBrakeCLI log lines reported when an encode fails
+HANDBRAKE_ERROR_LOG_LINES = 20
+
+# Buffer size for network uploads; large chunks keep the number of writes to the share low
+NETWORK_COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+_running_encodes_lock = threading.Lock()
+_running_encodes = {"count": 0}
+# Held by the encode that is deciding whether to start, so waiting encodes sample the CPU load
+# one after another and each reading is taken after the previous encode has started
+_encode_starter_lock = threading.Lock()
+
+_processed_files_lock = threading.Lock()
+_processed_files_cache = {"stat": None, "files": (set(), set())}
+
+# Uploads run one at a time in the background so they overlap with the next encode
+_uploader = ThreadPoolExecutor(max_workers=1)
+atexit.register(_uploader.shutdown)
+
 
 def process_all_videos() -> None:
     """
     Process all found videos in the input folder with the given handbrake settings.
     """
-    already_processed = read_processed_files()
-    files = os.listdir(INPUT_FOLDER)
-    for file in files:
-        input_file_path = os.path.join(INPUT_FOLDER, file)
-        if os.path.isfile(input_file_path) and file not in already_processed:
-            logger.info("New file found at %s.",
-                        os.path.splitext(input_file_path)[0])
-            output_file_path = os.path.join(OUTPUT_FOLDER, os.path.splitext(file)[0] + ".mkv")
-            encode_video(input_file_path, output_file_path)
-            # copy_to_network(output_file_path)
-        else:
-            logger.info("Already processed file %s in path: %s",
-                        file, os.path.splitext(input_file_path)[0])
-
-
-def read_processed_files() -> Set[str]:
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    os.makedirs(os.path.dirname(PROCESSED_FILES_PATH), exist_ok=True)
+    processed_names, processed_fingerprints = read_processed_files()
+    encodes = []
+    # Keep one buffered append handle for the whole sweep instead of reopening it per encode
+    # Tracks of queued files are read in the background while the running encodes proceed
+    with open(PROCESSED_FILES_PATH, 'a', buffering=8192, encoding="utf-8") as processed_file, \
+            ThreadPoolExecutor(max_workers=1) as prefetcher, \
+            ThreadPoolExecutor(max_workers=PARALLEL_ENCODES) as executor:
+        # Input folder with a trailing separator, so log messages can print it in front of a stem
+        input_prefix = os.path.join(INPUT_FOLDER, '')
+        # Files modified after this point may still be being copied into the input folder
+        stable_before = time.time() - STABLE_FILE_SECONDS
+        with os.scandir(INPUT_FOLDER) as entries:
+            for entry in entries:
+                stem = os.path.splitext(entry.name)[0]
+                # DirEntry caches the file type, so this check needs no extra stat call.
+                # Renamed copies of processed files are recognized by their fingerprint.
+                if (entry.is_file() and os.path.normcase(entry.name) not in processed_names
+                        and get_fingerprint(entry.stat()) not in processed_fingerprints):
+                    if entry.stat().st_mtime > stable_before:
+                        logger.info("File %s%s is still being written, skipping it for now.",
+                                    input_prefix, stem)
+                        continue
+                    logger.info("New file found at %s%s.", input_prefix, stem)
+                    output_file_path = os.path.join(OUTPUT_FOLDER, stem + ".mkv")
+                    media = prefetcher.submit(parse_media, entry.path)
+                    encodes.append(executor.submit(encode_video, entry.path, output_file_path,
+                                                   processed_file, media))
+                else:
+                    logger.info("Already processed file %s in path: %s%s",
+                                entry.name, input_prefix, stem)
+
+        # Surface exceptions raised inside the workers, without one failure hiding the others
+        for encode in encodes:
+            if (error := encode.exception()) is not None:
+                logger.error("An encode failed: %s", error, exc_info=error)
+
+
+def read_processed_files() -> Tuple[Set[str], Set[Tuple[int, int]]]:
     """
-    Returns a list of all processed files found in the text file.
+    Returns the names and content fingerprints of all processed files found in the text file.
+
+    Lines are JSON records holding the name, size and modification time of the input.
+    Plain lines from older versions only contribute their name. Names are keyed by file
+    name only, so lines written with a full input path still match after the input
+    folder has moved, and are case-normalized on case-insensitive file systems. The
+    parsed sets are reused until the file's modification time or size changes.
     """
-    processed_files = set()
-    if os.path.exists(PROCESSED_FILES_PATH):
+    try:
+        stat = os.stat(PROCESSED_FILES_PATH)
+    except FileNotFoundError:
+        return set(), set()
+
+    file_stat = (stat.st_mtime_ns, stat.st_size)
+    if _processed_files_cache["stat"] != file_stat:
+        # Read and split the file in one go instead of iterating it line by line
         with open(PROCESSED_FILES_PATH, 'r', encoding="utf-8") as f:
-            processed_files = {line.strip() for line in f}
-    return processed_files
+            lines = f.read().splitlines()
+
+        names = set()
+        fingerprints = set()
+        for line in lines:
+            line = line.strip()
+            if line.startswith('{'):
+                try:
+                    record = json.loads(line)
+                    names.add(os.path.normcase(record["name"]))
+                    fingerprints.add((record["size"], record["mtime"]))
+                    continue
+                except (ValueError, KeyError, TypeError):
+                    # Plain names can start with '{' too, and a crash can tear the last record
+                    logger.debug("Reading processed files line as plain name: %s", line)
+            names.add(os.path.normcase(os.path.basename(line)))
+        _processed_files_cache["files"] = (names, fingerprints)
+        _processed_files_cache["stat"] = file_stat
+    return _processed_files_cache["files"]
+
+
+def get_fingerprint(stat: os.stat_result) -> Tuple[int, int]:
+    """
+    Returns the size and modification time of a file, which identify its content
+    even after it was renamed.
+    """
+    return stat.st_size, int(stat.st_mtime)
 
 
-def write_processed_file(file_path: str) -> None:
+def write_processed_file(processed_file: TextIO, file_path: str) -> None:
     """
-    Updates the processed files file.
+    Updates the processed files file. Safe to call from parallel encode workers.
+
+    Args:
+        processed_file (TextIO): Open append handle of the processed files file.
+        file_path (str): Path of the processed input file.
     """
-    with open(PROCESSED_FILES_PATH, 'a', encoding="utf-8") as f:
-        f.write(f"{os.path.basename(file_path)}\n")
+    size, mtime = get_fingerprint(os.stat(file_path))
+    record = {"name": os.path.basename(file_path), "size": size, "mtime": mtime}
+    with _processed_files_lock:
+        processed_file.write(f"{json.dumps(record)}\n")
+        # Flush right away so a crash never loses a finished encode
+        processed_file.flush()
 
 
-def get_audio_indices(input_file: str, languages: List[str] = None, first_only: bool = True) -> str:
+def parse_media(input_file: str) -> Tuple[str, List[dict]]:
     """
-    Returns indices of audio streams matching specified languages.
+    Reads the tracks of a media file once and selects the audio and subtitle tracks to encode.
 
     Args:
         input_file (str): Path to the video file.
-        languages (List[str], optional): Language codes to match. Defaults to ['de', 'en'].
-        first_only (bool, optional): If True, returns only the first match per language.
 
     Returns:
-        str: Comma-separated indices of matching audio streams or an empty string if none.
+        Tuple[str, List[dict]]: Comma-separated indices of the selected audio streams and
+            the selected subtitles, both empty if the file can't be read.
     """
-    if languages is None:
-        languages = ['de', 'en']
-
     try:
-        media_info = pymediainfo.MediaInfo.parse(input_file)
-        audio_tracks = media_info.audio_tracks
+        tracks = get_tracks(input_file)
     except FileNotFoundError:
         logger.error('Input file not found: %s', input_file)
-        return ""
+        return "", []
     except ValueError as e:
         logger.error('Value error: %s', e)
-        return ""
+        return "", []
 
-    if not audio_tracks:
+    if not tracks["audio"]:
         logger.warning('No audio tracks found in the media file: %s', input_file)
-        return ""
 
-    # Collect indices of audio tracks matching the specified languages
-    indices = []
+    return get_audio_indices(tracks["audio"]), get_subtitles(tracks["text"])
 
-    # Process languages in the order they are specified in the input list
-    for lang in languages:
-        found = False
-        for i, track in enumerate(audio_tracks):
-            track_lang = getattr(track, 'language', None)
-            if track_lang == lang:
-                indices.append(str(i + 1))  # Append the 1-based index
-                if first_only:
-                    found = True
-                    break  # Stop searching after the first match for this language
-        if first_only and found:
-            continue  # Move to the next language if first_only is True
 
-    return ','.join(indices)
+def get_audio_indices(audio_tracks: List[dict], languages: List[str] = None,
+                      first_only: bool = True) -> str:
+    """
+    Returns indices of audio streams matching specified languages.
 
+    Args:
+        audio_tracks (List[dict]): Audio tracks of the video file.
+        languages (List[str], optional): Language codes to match. Defaults to ['de', 'en'].
+        first_only (bool, optional): If True, returns only the first match per language.
 
-def get_subtitles(input_file):
+    Returns:
+        str: Comma-separated indices of matching audio streams or an empty string if none.
     """
-    Extracts and filters subtitle tracks from a media file based on predefined criteria.
+    if languages is None:
+        languages = ['de', 'en']
+
+    # Bucket the 1-based track indices of the requested languages in a single pass
+    wanted_languages = set(languages)
+    indices_by_language: Dict[str, List[str]] = {}
+    for i, track in enumerate(audio_tracks):
+        language = track['language']
+        if language in wanted_languages:
+            lang_indices = indices_by_language.setdefault(language, [])
+            if not (first_only and lang_indices):
+                lang_indices.append(str(i + 1))
+
+    # Join the languages in the order they are specified in the input list
+    return ','.join(index for lang in languages for index in indices_by_language.get(lang, ()))
+
+
+def match_subtitle_criterion(language: str, proportion: float,
+                             matched_criteria: int) -> Optional[int]:
+    """
+    Finds the first subtitle criterion a track meets that hasn't selected a track yet.
+
+    Args:
+        language (str): Language code of the subtitle track.
+        proportion (float): Share of the track in the file, in per mille.
+        matched_criteria (int): Bitmask of the criteria indices that already selected a track.
+
+    Returns:
+        Optional[int]: Index of the criterion in SUBTITLE_CRITERIA,
+            or None if the track meets no unused criterion.
+    """
+    for index, (_, _, condition, _) in enumerate(SUBTITLE_CRITERIA):
+        # Each criterion selects at most one track, so skip used ones before evaluating
+        if not matched_criteria & (1 << index) and condition(language, proportion):
+            return index
+    return None
+
+
+def get_subtitles(text_tracks):
+    """
+    Filters the subtitle tracks of a media file based on predefined criteria.
 
     Parameters:
-    - input_file (str): Path to the media file.
+    - text_tracks (list of dict): Subtitle tracks of the media file.
 
     Returns:
     - list of dict: Filtered subtitles with details like track number,
         language, size, proportion, default status, priority, and criterion name.
-
-    Raises:
-    - FileNotFoundError: Logs error if file is not found.
     """
 
-    try:
-        media_info = pymediainfo.MediaInfo.parse(input_file)
-        text_tracks = media_info.text_tracks
-    except FileNotFoundError:
-        logger.error('Input file not found: %s', input_file)
-        return ""
-
     subtitle_list = []
-    criteria_status = {criterion["name"]: False for criterion in SUBTITLE_CRITERIA}
+    matched_criteria = 0
 
     #  TODO: Criterion for foreign langugae check needs to based on actual usage, not by proportion
 
     for track in text_tracks:
-        subtitle_info = {
-            "track_nr": int(track.stream_identifier) + 1,
-            "language": track.language,
-            "stream_size": track.stream_size,
-            "proportion": float(track.proportion_of_this_stream) * 1000,
-            "default": track.default,
-        }
-
-        for criterion in SUBTITLE_CRITERIA:
-            if criterion["condition"](subtitle_info) and not criteria_status[criterion["name"]]:
-                subtitle_info["default"] = criterion["default"]
-                subtitle_info['priority'] = criterion["priority"]
-                subtitle_info['name'] = criterion["name"]
-                subtitle_list.append(subtitle_info)
-                criteria_status[criterion["name"]] = True
-                break
+        language = track["language"]
+        proportion = float(track["proportion_of_this_stream"]) * 1000
+
+        index = match_subtitle_criterion(language, proportion, matched_criteria)
+        if index is None:
+            continue
+
+        name, priority, _, default = SUBTITLE_CRITERIA[index]
+        matched_criteria |= 1 << index
+        subtitle_list.append({
+            "track_nr": int(track["stream_identifier"]) + 1,
+            "language": language,
+            "stream_size": track["stream_size"],
+            "proportion": proportion,
+            "default": default,
+            "priority": priority,
+            "name": name,
+        })
 
     subtitle_list.sort(key=lambda x: x['priority'])
     logger.debug("Using these subtitles for encoding: %s", subtitle_list)
@@ -152,20 +312,17 @@ def get_subtitles(input_file):
     return subtitle_list
 
 
-def build_subtitle_command(input_file):
+def build_subtitle_command(subtitles):
     """
     Adds subtitle-related options to a HandBrake CLI command based on the provided subtitles.
 
     Parameters:
-    - command (list): The initial list of command-line arguments for HandBrake.
-    - input_file (str): Path to the media file.
+    - subtitles (list of dict): The subtitles selected by get_subtitles.
 
     Returns:
     - list: The list with added subtitle options.
     """
 
-    subtitles = get_subtitles(input_file)
-
     logger.debug("Check for subtitle options to add.")
     if not subtitles:
         logger.debug("No subtitles found, skipping analyse.")
@@ -201,16 +358,30 @@ def build_subtitle_command(input_file):
     return subtitle_command
 
 
-def copy_to_network(src_file):
+def copy_to_network(src_file: str) -> None:
     """
-    WIP: basic implementation for copying the final video to a network drive
+    Copies the final video to the network drive.
 
-    works, but is slow
+    Runs on the background uploader, so the copy overlaps with the next encode.
+
+    Args:
+        src_file (str): Path to the encoded video file.
     """
     logger.debug("Checking connection to %s", NETWORK_FOLDER_PATH)
     if os.path.exists(NETWORK_FOLDER_PATH):
         logger.info("Connection to %s successful, starting upload of %s", NETWORK_FOLDER_PATH, src_file)
-        shutil.copy(src_file, NETWORK_FOLDER_PATH)
+        dst_file = os.path.join(NETWORK_FOLDER_PATH, os.path.basename(src_file))
+        # Copy into a temporary file, so a failed upload never leaves a truncated video behind
+        partial_dst_file = dst_file + ".part"
+        try:
+            with open(src_file, 'rb') as src, open(partial_dst_file, 'wb') as dst:
+                shutil.copyfileobj(src, dst, NETWORK_COPY_BUFFER_SIZE)
+            os.replace(partial_dst_file, dst_file)
+        except OSError as e:
+            logger.error("An error occurred while copying %s to %s: %s", src_file, dst_file, e)
+            if os.path.exists(partial_dst_file):
+                os.unlink(partial_dst_file)
+            return
         logger.info("File %s copied to network folder %s successfully!", src_file, NETWORK_FOLDER_PATH)
     else:
         logger.info("Connection to %s failed; skipping upload :(", NETWORK_FOLDER_PATH)
@@ -225,52 +396,81 @@ def connect_to_samba():
     conn.close()
 
 
-def encode_video(input_file: str, output_file: str) -> None:
+@contextlib.contextmanager
+def running_encode() -> Iterator[None]:
+    """
+    Counts an encode as running for the duration of the block.
+
+    While other encodes are running, first waits until the CPU load leaves room for
+    another one, so fewer encodes run in parallel while the machine is busy with other
+    work. Without other encodes the block is entered right away. Only one encode waits
+    at a time, so encodes start one by one instead of all at once on the same reading.
+    """
+    with _encode_starter_lock:
+        while True:
+            with _running_encodes_lock:
+                if not _running_encodes["count"]:
+                    _running_encodes["count"] += 1
+                    break
+            cpu_load = psutil.cpu_percent(interval=CPU_LOAD_SAMPLE_SECONDS)
+            with _running_encodes_lock:
+                if not _running_encodes["count"] or cpu_load <= MAX_START_CPU_LOAD:
+                    _running_encodes["count"] += 1
+                    break
+            logger.debug("CPU load at %s%%, waiting before starting the next encode.", cpu_load)
+
+    try:
+        yield
+    finally:
+        with _running_encodes_lock:
+            _running_encodes["count"] -= 1
+
+
+def encode_video(input_file: str, output_file: str, processed_file: TextIO,
+                 media: Future) -> None:
     """
     Encodes a video file using HandBrakeCLI.
 
     Args:
         input_file (str): Path to the input video file.
         output_file (str): Path to save the encoded output video file.
+        processed_file (TextIO): Open append handle the input is recorded in on success.
+        media (Future): Pending result of parse_media for the input file.
     """
 
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    audio_command, subtitles = media.result()
 
-    audio_command = get_audio_indices(input_file)
+    # Encode into a temporary file, so an interrupted encode never leaves a partial output behind
+    partial_output_file = output_file + ".part"
 
     command = [
-        HANDBRAKE_CLI_PATH,
+        *HANDBRAKE_COMMAND,
         '--input', input_file,
-        '--output', output_file,
-        '--encoder', 'x265_10bit',
-        '--encoder-preset', 'slow',
-        '--encoder-profile', 'main10',
-        '--quality', '19',
-        '--vfr',
-        '--crop-mode', ' auto',
-        '--auto-anamorphic',
-        '--lapsharp=light',
-        '--hqdn3d=light',
-        '--aencoder', 'copy',
-        '--audio-copy-mask', 'ac3,aac,eac3,dts',
-        '--audio-fallback', 'flac16',
+        '--output', partial_output_file,
+        *HANDBRAKE_OPTIONS,
         '--audio', audio_command,
-        '--aname', 'Deutsch,English',
-        '--native-language', 'deu',
-        '--markers',
-        '--turbo',
-        '--format', 'av_mkv',
     ]
 
-    subtitle_command = build_subtitle_command(input_file)
+    subtitle_command = build_subtitle_command(subtitles)
     command.extend(subtitle_command)
 
     try:
         logger.info("Starting encoding with command: %s", command)
-        subprocess.run(command, check=True)
-        write_processed_file(input_file)
+        # Progress output is not needed, HandBrake's log on stderr is only kept for errors
+        with running_encode():
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           text=True, errors="replace", creationflags=LOW_PRIORITY_CREATIONFLAGS)
+        os.replace(partial_output_file, output_file)
+        write_processed_file(processed_file, input_file)
         logger.info("Successfully encoded %s to %s", input_file, output_file)
+        _uploader.submit(copy_to_network, output_file)
     except subprocess.CalledProcessError as e:
-        logger.error("An error occurred while encoding %s: %s", input_file, e)
-    except FileNotFoundError as err:
-        logger.error("File not found: %s", err)
+        logger.error("An error occurred while encoding %s: %s\n%s", input_file, e,
+                     "\n".join(e.stderr.splitlines()[-HANDBRAKE_ERROR_LOG_LINES:]))
+        if os.path.exists(partial_output_file):
+            os.unlink(partial_output_file)
+    except OSError as e:
+        # E.g. the output file is still open in a player on Windows and can't be replaced
+        logger.error("An error occurred while writing the encode of %s: %s", input_file, e)
+        if os.path.exists(partial_output_file):
+            os.unlink(partial_output_file)
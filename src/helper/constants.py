@@ -3,27 +3,38 @@
 INPUT_FOLDER = "videos\\input\\"
 OUTPUT_FOLDER = "videos\\output\\"
 PROCESSED_FILES_PATH = "temp/processed_files.txt"
+MEDIAINFO_CACHE_PATH = "temp/mediainfo_cache.pkl"
 HANDBRAKE_CLI_PATH = "src/HandBrakeCLI.exe"
 NETWORK_FOLDER_PATH = "PATH_TO_NETWORK_FOLDER"
+THREADS_PER_ENCODE = 6
+# Seconds a new input file must stay unchanged before it is considered completely copied
+STABLE_FILE_SECONDS = 10
 
-SUBTITLE_CRITERIA = [
-    {
-        "name": "Fremdsprache",
-        "priority": 1,
-        "condition": lambda subtitle_info: subtitle_info["language"] == 'de'
-                                           and subtitle_info["proportion"] < 0.1,
-        "default": "Yes",
-    },
-    {
-        "name": "Deutsch",
-        "priority": 2,
-        "condition": lambda subtitle_info: subtitle_info["language"] == 'de',
-        "default": "No",
-    },
-    {
-        "name": "English",
-        "priority": 3,
-        "condition": lambda subtitle_info: subtitle_info["language"] == 'en',
-        "default": "No",
-    }
-]
+
+def is_foreign_language_subtitle(language: str, proportion: float) -> bool:
+    """
+    Matches German subtitles that only cover a small part of the video, e.g. foreign dialogue.
+    """
+    return language == 'de' and proportion < 0.1
+
+
+def is_german_subtitle(language: str, _proportion: float) -> bool:
+    """
+    Matches German subtitles.
+    """
+    return language == 'de'
+
+
+def is_english_subtitle(language: str, _proportion: float) -> bool:
+    """
+    Matches English subtitles.
+    """
+    return language == 'en'
+
+
+# Subtitle criteria as (name, priority, condition, default), checked in this order
+SUBTITLE_CRITERIA = (
+    ("Fremdsprache", 1, is_foreign_language_subtitle, "Yes"),
+    ("Deutsch", 2, is_german_subtitle, "No"),
+    ("English", 3, is_english_subtitle, "No"),
+)
@@ -15,7 +15,4 @@ def find_first(items: List[T], predicate: Callable[[T], bool]) -> Optional[T]:
     Returns:
         Optional[T]: The first matching item if found, otherwise None.
     """
-    for item in items:
-        if predicate(item):
-            return item
-    return None
+    return next(filter(predicate, items), None)
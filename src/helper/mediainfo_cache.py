@@ -0,0 +1,89 @@
+"""Module providing a persistent cache for the MediaInfo track metadata of videos."""
+import functools
+import logging
+import os
+import pickle
+import threading
+from typing import Any, Dict, List
+
+import pymediainfo
+
+from src.helper.constants import MEDIAINFO_CACHE_PATH
+
+# Only the track fields the encoder reads are cached, to keep the cache file small
+AUDIO_TRACK_FIELDS = ('language',)
+TEXT_TRACK_FIELDS = ('stream_identifier', 'language', 'stream_size', 'proportion_of_this_stream')
+
+_cache_lock = threading.Lock()
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def _loaded_cache() -> Dict[str, tuple]:
+    """
+    Loads the cache file once, mapping real paths to (mtime_ns, size, tracks).
+
+    Entries of files that no longer exist are dropped, so the cache doesn't keep growing
+    with every video that was encoded and removed.
+    """
+    try:
+        with open(MEDIAINFO_CACHE_PATH, 'rb') as f:
+            cache = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return {}
+    return {path: entry for path, entry in cache.items() if os.path.exists(path)}
+
+
+def _save_cache(cache: Dict[str, tuple]) -> None:
+    """
+    Writes the cache file atomically, so a crash never leaves a truncated cache behind.
+    """
+    os.makedirs(os.path.dirname(MEDIAINFO_CACHE_PATH), exist_ok=True)
+    partial_cache_path = MEDIAINFO_CACHE_PATH + ".part"
+    with open(partial_cache_path, 'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(partial_cache_path, MEDIAINFO_CACHE_PATH)
+
+
+def get_tracks(path: str) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Returns the audio and text tracks of a media file, parsing it with MediaInfo only
+    if it is not cached yet or has changed since it was cached.
+
+    Args:
+        path (str): Path to the media file.
+
+    Returns:
+        Dict[str, List[Dict[str, Any]]]: The cached fields of the tracks under the
+            keys 'audio' and 'text'.
+
+    Raises:
+        FileNotFoundError: If the media file does not exist.
+    """
+    stat = os.stat(path)
+    key = os.path.realpath(path)
+    file_stat = (stat.st_mtime_ns, stat.st_size)
+
+    with _cache_lock:
+        entry = _loaded_cache().get(key)
+    if entry is not None and entry[:2] == file_stat:
+        return entry[2]
+
+    # Parse outside the lock, so parallel encodes don't wait on each other
+    media_info = pymediainfo.MediaInfo.parse(path)
+    tracks = {
+        "audio": [{field: getattr(track, field) for field in AUDIO_TRACK_FIELDS}
+                  for track in media_info.audio_tracks],
+        "text": [{field: getattr(track, field) for field in TEXT_TRACK_FIELDS}
+                 for track in media_info.text_tracks],
+    }
+
+    with _cache_lock:
+        cache = _loaded_cache()
+        cache[key] = (*file_stat, tracks)
+        # The cache only saves work, a failed write must not fail the encode
+        try:
+            _save_cache(cache)
+        except OSError as e:
+            logger.error("An error occurred while saving the MediaInfo cache: %s", e)
+    return tracks